@@ -0,0 +1,15 @@
+import os
+from celery import Celery
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Kept apart from tasks.py so the web process can enqueue work without importing
+# the CV pipeline (Supabase client, LLM provider, tokenizer) at startup
+celery_app = Celery("tasks", broker=REDIS_URL, backend=REDIS_URL)
+
+# The web process enqueues by this name with send_task
+RUN_ANALYSIS_TASK = "run_analysis"
@@ -7,7 +7,8 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from . import process_cvs
+from celery.result import AsyncResult
+from .celery_app import celery_app, RUN_ANALYSIS_TASK
 
 app = FastAPI(root_path="/api")
 
@@ -31,19 +32,19 @@ class AnalysisRequest(BaseModel):
 @app.post("/analyze")
 async def analyze_cvs(request: AnalysisRequest):
     try:
-        # In a real app, we might want to filter by job_id if provided,
-        # but process_cvs currently processes all open jobs.
-        # We can modify process_cvs to accept arguments later if needed.
+        # Analysis can take minutes, so hand it to a Celery worker and return immediately
+        task = celery_app.send_task(RUN_ANALYSIS_TASK, args=[request.job_id])
         
-        # Capture output? For now just run it.
-        # Note: This is a blocking call. For production, use background tasks.
-        process_cvs.process_cvs()
-        
-        return {"message": "Analysis completed successfully", "status": "success"}
+        return {"task_id": task.id, "status": "queued"}
     except Exception as e:
-        print(f"Error during analysis: {e}")
+        print(f"Error queuing analysis: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/analyze/status/{task_id}")
+async def analysis_status(task_id: str):
+    result = AsyncResult(task_id, app=celery_app)
+    return {"task_id": task_id, "status": result.state}
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
@@ -1,81 +1,435 @@
 import os
-import json
-import time
+import orjson
+import asyncio
+import hashlib
+import itertools
 from abc import ABC, abstractmethod
 import google.generativeai as genai
-from openai import OpenAI
+from google.ai import generativelanguage as glm
+from google.api_core.client_options import ClientOptions
+from google.api_core.exceptions import ResourceExhausted
+from openai import OpenAI, AsyncOpenAI
 import ollama
+import ijson
+import redis
+from pydantic import ValidationError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from .schemas import AnalysisResult, Evaluation, ExtractedInfo
+
+# How long cached LLM responses are kept (default 30 days)
+CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(86400 * 30)))
+# Number of independent Gemini clients (gRPC channels) used for async requests
+GOOGLE_CONCURRENCY = int(os.environ.get("GOOGLE_CONCURRENCY", "4"))
+
+# Back off only when the provider reports its quota is exhausted (HTTP 429)
+retry_on_rate_limit = retry(
+    retry=retry_if_exception_type(ResourceExhausted),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+
+async def analysis_events(result: AnalysisResult | None):
+    # Turns a complete analysis into the same events stream_analysis yields
+    if not result:
+        return
+    yield "extracted_info", result.extracted_info
+    for evaluation in result.evaluations:
+        yield "evaluation", evaluation
 
 class LLMProvider(ABC):
     @abstractmethod
-    def generate_analysis(self, prompt: str) -> dict:
+    def generate_analysis(self, prompt: str) -> AnalysisResult | None:
         pass
 
+    async def generate_analysis_async(self, prompt: str) -> AnalysisResult | None:
+        # Fallback for providers without a native async client
+        return await asyncio.to_thread(self.generate_analysis, prompt)
+
+    # Providers with a batch endpoint set this and implement submit_batch/collect_batch
+    supports_batch = False
+
+    def submit_batch(self, prompts: list[str]) -> str:
+        # Starts a batch job and returns its id without waiting for it
+        raise NotImplementedError(f"{type(self).__name__} has no batch endpoint")
+
+    def collect_batch(self, batch_id: str, size: int) -> list[AnalysisResult | None] | None:
+        # Results in prompt order once the batch has finished, None while it is still running
+        raise NotImplementedError(f"{type(self).__name__} has no batch endpoint")
+
+    def get_cached(self, prompt: str) -> AnalysisResult | None:
+        # Lets the batch path skip prompts that already have a result
+        return None
+
+    async def stream_analysis(self, prompt: str):
+        # Yields ("extracted_info", ExtractedInfo) and ("evaluation", Evaluation) events.
+        # Fallback for providers without streaming: emit them once the full response is in
+        async for event in analysis_events(await self.generate_analysis_async(prompt)):
+            yield event
+
+    # Async client of the current run, see _get_async_client
+    _async_client = None
+
+    def _create_async_client(self):
+        raise NotImplementedError(f"{type(self).__name__} has no async client")
+
+    def _get_async_client(self):
+        # Created per run: the client's httpx pool is bound to the event loop of the
+        # asyncio.run that opened it, so aclose() drops it before that loop ends
+        if self._async_client is None:
+            self._async_client = self._create_async_client()
+        return self._async_client
+
+    async def aclose(self):
+        # Closes async clients bound to the current event loop; called at the end of each run
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
 class GoogleProvider(LLMProvider):
-    def __init__(self, model_name: str, api_key: str):
+    def __init__(self, model_name: str, api_key: str, system_prompt: str | None = None, pool_size: int = GOOGLE_CONCURRENCY):
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name)
+        self.model_name = model_name
+        self.api_key = api_key
+        self.system_prompt = system_prompt
+        self.pool_size = max(1, pool_size)
+        self.model = self._make_model()
+        self._pool_models = []
+        self._model_pool = None
+        self._pool_loop = None
+
+    def _make_model(self):
+        # Structured output: the response body is JSON matching AnalysisResult
+        return genai.GenerativeModel(
+            self.model_name,
+            system_instruction=self.system_prompt,
+            generation_config={"response_mime_type": "application/json", "response_schema": AnalysisResult}
+        )
+
+    def _next_async_model(self):
+        # Round-robin over models that each own an async client, so concurrent requests
+        # are spread across independent gRPC channels instead of the SDK's shared default.
+        # gRPC aio channels are bound to their event loop, so the pool is built per run
+        # and closed by aclose() before that run's loop ends.
+        loop = asyncio.get_running_loop()
+        if self._pool_loop is not loop:
+            self._pool_models = []
+            for _ in range(self.pool_size):
+                model = self._make_model()
+                # Private attribute: google-generativeai 0.8.x GenerativeModel.generate_content_async
+                # only creates the shared default client when _async_client is None
+                model._async_client = glm.GenerativeServiceAsyncClient(
+                    client_options=ClientOptions(api_key=self.api_key)
+                )
+                self._pool_models.append(model)
+            self._model_pool = itertools.cycle(self._pool_models)
+            self._pool_loop = loop
+        return next(self._model_pool)
+
+    async def aclose(self):
+        for model in self._pool_models:
+            await model._async_client.transport.close()
+        self._pool_models = []
+        self._model_pool = None
+        self._pool_loop = None
+
+    def _parse(self, response) -> AnalysisResult:
+        return AnalysisResult.model_validate_json(response.text)
+
+    @retry_on_rate_limit
+    def _generate(self, prompt: str):
+        return self.model.generate_content(prompt)
 
-    def generate_analysis(self, prompt: str) -> dict:
+    @retry_on_rate_limit
+    async def _generate_async(self, prompt: str, stream: bool = False):
+        return await self._next_async_model().generate_content_async(prompt, stream=stream)
+
+    def generate_analysis(self, prompt: str) -> AnalysisResult | None:
+        try:
+            response = self._generate(prompt)
+            return self._parse(response)
+        except Exception as e:
+            print(f"Error generating content with Google: {e}")
+            return None
+
+    async def generate_analysis_async(self, prompt: str) -> AnalysisResult | None:
         try:
-            # Add delay to avoid rate limits
-            time.sleep(2) 
-            response = self.model.generate_content(prompt)
-            # Clean up response text to ensure it's valid JSON
-            text = response.text.replace("```json", "").replace("```", "").strip()
-            return json.loads(text)
+            response = await self._generate_async(prompt)
+            return self._parse(response)
         except Exception as e:
             print(f"Error generating content with Google: {e}")
-            return {}
+            return None
+
+    async def stream_analysis(self, prompt: str):
+        # Parse the JSON incrementally so each section is available as soon as it is generated
+        info_items = ijson.sendable_list()
+        eval_items = ijson.sendable_list()
+        info_parser = ijson.items_coro(info_items, "extracted_info", use_float=True)
+        eval_parser = ijson.items_coro(eval_items, "evaluations.item", use_float=True)
+
+        response = await self._generate_async(prompt, stream=True)
+        async for chunk in response:
+            data = chunk.text.encode("utf-8")
+            info_parser.send(data)
+            eval_parser.send(data)
+            for info in info_items:
+                yield "extracted_info", ExtractedInfo.model_validate(info)
+            for evaluation in eval_items:
+                yield "evaluation", Evaluation.model_validate(evaluation)
+            del info_items[:]
+            del eval_items[:]
+
+        info_parser.close()
+        eval_parser.close()
 
 class OpenAIProvider(LLMProvider):
-    def __init__(self, model_name: str, api_key: str):
+    def __init__(self, model_name: str, api_key: str, system_prompt: str | None = None):
         self.client = OpenAI(api_key=api_key)
+        self.api_key = api_key
         self.model_name = model_name
+        self.system_prompt = system_prompt or "You are a helpful assistant that outputs JSON."
+        # Routes requests sharing the system prompt to the same prompt cache
+        self.prompt_cache_key = hashlib.blake2b(self.system_prompt.encode("utf-8"), digest_size=8).hexdigest()
+
+    def _create_async_client(self) -> AsyncOpenAI:
+        return AsyncOpenAI(api_key=self.api_key)
 
-    def generate_analysis(self, prompt: str) -> dict:
+    def _messages(self, prompt: str) -> list:
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": prompt}
+        ]
+
+    def generate_analysis(self, prompt: str) -> AnalysisResult | None:
         try:
-            response = self.client.chat.completions.create(
+            response = self.client.chat.completions.parse(
                 model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that outputs JSON."},
-                    {"role": "user", "content": prompt}
-                ],
-                response_format={"type": "json_object"}
+                messages=self._messages(prompt),
+                response_format=AnalysisResult,
+                extra_body={"prompt_cache_key": self.prompt_cache_key}
             )
-            return json.loads(response.choices[0].message.content)
+            return response.choices[0].message.parsed
         except Exception as e:
             print(f"Error generating content with OpenAI: {e}")
-            return {}
+            return None
+
+    async def generate_analysis_async(self, prompt: str) -> AnalysisResult | None:
+        try:
+            response = await self._get_async_client().chat.completions.parse(
+                model=self.model_name,
+                messages=self._messages(prompt),
+                response_format=AnalysisResult,
+                extra_body={"prompt_cache_key": self.prompt_cache_key}
+            )
+            return response.choices[0].message.parsed
+        except Exception as e:
+            print(f"Error generating content with OpenAI: {e}")
+            return None
+
+    supports_batch = True
+
+    def submit_batch(self, prompts: list[str]) -> str:
+        # Private SDK helper, imported here so changes to it can only break OpenAI batches
+        from openai.lib._pydantic import to_strict_json_schema
+
+        # The structured output format parse() builds for single calls
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "AnalysisResult",
+                "strict": True,
+                "schema": to_strict_json_schema(AnalysisResult)
+            }
+        }
+
+        # Submit all prompts as one Batch API job (half price, separate rate limits)
+        lines = [
+            orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "messages": self._messages(prompt),
+                    "response_format": response_format,
+                    "prompt_cache_key": self.prompt_cache_key
+                }
+            })
+            for i, prompt in enumerate(prompts)
+        ]
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"Submitted OpenAI batch {batch.id} with {len(prompts)} requests")
+        return batch.id
+
+    def collect_batch(self, batch_id: str, size: int) -> list[AnalysisResult | None] | None:
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status not in ("completed", "failed", "expired", "cancelled"):
+            return None
+
+        results = [None for _ in range(size)]
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"OpenAI batch {batch.id} finished with status: {batch.status}")
+            return results
+
+        output = self.client.files.content(batch.output_file_id).content
+        for line in output.splitlines():
+            item = orjson.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") != 200:
+                print(f"OpenAI batch request {item.get('custom_id')} failed: {item.get('error')}")
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[int(item["custom_id"])] = AnalysisResult.model_validate_json(content)
+            except (KeyError, IndexError, ValueError) as e:
+                print(f"Error parsing OpenAI batch result {item.get('custom_id')}: {e}")
+        return results
 
 class OllamaProvider(LLMProvider):
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, system_prompt: str | None = None):
         self.model_name = model_name
+        self.system_prompt = system_prompt
+        self.response_format = AnalysisResult.model_json_schema()
+
+    def _create_async_client(self) -> ollama.AsyncClient:
+        return ollama.AsyncClient()
+
+    def _messages(self, prompt: str) -> list:
+        messages = [{'role': 'user', 'content': prompt}]
+        if self.system_prompt:
+            messages.insert(0, {'role': 'system', 'content': self.system_prompt})
+        return messages
+
+    def _parse(self, response) -> AnalysisResult:
+        return AnalysisResult.model_validate_json(response['message']['content'])
+
+    def generate_analysis(self, prompt: str) -> AnalysisResult | None:
+        try:
+            response = ollama.chat(model=self.model_name, messages=self._messages(prompt), format=self.response_format)
+            return self._parse(response)
+        except Exception as e:
+            print(f"Error generating content with Ollama: {e}")
+            return None
 
-    def generate_analysis(self, prompt: str) -> dict:
+    async def generate_analysis_async(self, prompt: str) -> AnalysisResult | None:
         try:
-            response = ollama.chat(model=self.model_name, messages=[
-                {
-                    'role': 'user',
-                    'content': prompt,
-                },
-            ])
-            # Attempt to parse JSON from the response
-            content = response['message']['content']
-            # Find JSON block if wrapped in markdown
-            if "```json" in content:
-                content = content.split("```json")[1].split("```")[0].strip()
-            elif "```" in content:
-                 content = content.split("```")[1].split("```")[0].strip()
-            
-            return json.loads(content)
+            response = await self._get_async_client().chat(model=self.model_name, messages=self._messages(prompt), format=self.response_format)
+            return self._parse(response)
         except Exception as e:
             print(f"Error generating content with Ollama: {e}")
-            return {}
+            return None
+
+class CachedProvider(LLMProvider):
+    # Wraps any provider with an exact-match Redis cache keyed on the prompt
+    def __init__(self, provider: LLMProvider, redis_url: str, namespace: str):
+        self.provider = provider
+        self.redis = redis.Redis.from_url(redis_url)
+        self.namespace = namespace
+
+    def _key(self, prompt: str) -> str:
+        digest = hashlib.blake2b(f"{self.namespace}:{prompt}".encode("utf-8"), digest_size=16).hexdigest()
+        return f"llm:{digest}"
+
+    def _get(self, prompt: str) -> AnalysisResult | None:
+        try:
+            cached = self.redis.get(self._key(prompt))
+            return AnalysisResult.model_validate_json(cached) if cached else None
+        except (redis.RedisError, ValidationError) as e:
+            print(f"Error reading LLM cache: {e}")
+            return None
+
+    def _set(self, prompt: str, result: AnalysisResult | None):
+        self._set_key(self._key(prompt), result)
+
+    def _set_key(self, key: str, result: AnalysisResult | None):
+        # Don't cache failures, so they get retried on the next run
+        if not result:
+            return
+        try:
+            self.redis.setex(key, CACHE_TTL, result.model_dump_json())
+        except redis.RedisError as e:
+            print(f"Error writing LLM cache: {e}")
+
+    def generate_analysis(self, prompt: str) -> AnalysisResult | None:
+        cached = self._get(prompt)
+        if cached is not None:
+            return cached
+        result = self.provider.generate_analysis(prompt)
+        self._set(prompt, result)
+        return result
+
+    async def generate_analysis_async(self, prompt: str) -> AnalysisResult | None:
+        cached = await asyncio.to_thread(self._get, prompt)
+        if cached is not None:
+            return cached
+        result = await self.provider.generate_analysis_async(prompt)
+        await asyncio.to_thread(self._set, prompt, result)
+        return result
+
+    async def stream_analysis(self, prompt: str):
+        cached = await asyncio.to_thread(self._get, prompt)
+        if cached is not None:
+            async for event in analysis_events(cached):
+                yield event
+            return
+
+        extracted_info = None
+        evaluations = []
+        async for kind, value in self.provider.stream_analysis(prompt):
+            if kind == "extracted_info":
+                extracted_info = value
+            else:
+                evaluations.append(value)
+            yield kind, value
+
+        # Only reached when the stream completed without errors
+        if extracted_info is not None and evaluations:
+            result = AnalysisResult(extracted_info=extracted_info, evaluations=evaluations)
+            await asyncio.to_thread(self._set, prompt, result)
+
+    async def aclose(self):
+        await self.provider.aclose()
+
+    @property
+    def supports_batch(self) -> bool:
+        return self.provider.supports_batch
+
+    def get_cached(self, prompt: str) -> AnalysisResult | None:
+        return self._get(prompt)
+
+    def submit_batch(self, prompts: list[str]) -> str:
+        batch_id = self.provider.submit_batch(prompts)
+        # Results arrive in a later run without their prompts, so keep the cache keys
+        try:
+            self.redis.setex(f"llm:batch:{batch_id}", CACHE_TTL, orjson.dumps([self._key(p) for p in prompts]))
+        except redis.RedisError as e:
+            print(f"Error writing LLM cache: {e}")
+        return batch_id
+
+    def collect_batch(self, batch_id: str, size: int) -> list[AnalysisResult | None] | None:
+        results = self.provider.collect_batch(batch_id, size)
+        if results is None:
+            return None
+        try:
+            keys = self.redis.get(f"llm:batch:{batch_id}")
+        except redis.RedisError as e:
+            print(f"Error reading LLM cache: {e}")
+            keys = None
+        for key, result in zip(orjson.loads(keys) if keys else [], results):
+            self._set_key(key, result)
+        return results
 
 class LLMFactory:
     @staticmethod
-    def create_provider(config: dict) -> LLMProvider:
+    def create_provider(config: dict, system_prompt: str | None = None) -> LLMProvider:
         provider_type = config.get("provider", "google").lower()
         model_name = config.get("model", "gemini-2.0-flash")
 
@@ -83,16 +437,23 @@ class LLMFactory:
             api_key = os.environ.get("GOOGLE_API_KEY")
             if not api_key:
                 raise ValueError("GOOGLE_API_KEY not found in environment variables")
-            return GoogleProvider(model_name, api_key)
-        
+            provider = GoogleProvider(model_name, api_key, system_prompt)
+
         elif provider_type == "openai":
             api_key = os.environ.get("OPENAI_API_KEY")
             if not api_key:
                 raise ValueError("OPENAI_API_KEY not found in environment variables")
-            return OpenAIProvider(model_name, api_key)
-            
+            provider = OpenAIProvider(model_name, api_key, system_prompt)
+
         elif provider_type == "ollama":
-            return OllamaProvider(model_name)
-            
+            provider = OllamaProvider(model_name, system_prompt)
+
         else:
             raise ValueError(f"Unsupported provider: {provider_type}")
+
+        # Reuse previous analyses of identical prompts when Redis is available
+        redis_url = os.environ.get("REDIS_URL")
+        if redis_url:
+            provider = CachedProvider(provider, redis_url, f"{provider_type}:{model_name}:{system_prompt or ''}")
+
+        return provider
@@ -0,0 +1,10 @@
+def extract_text_from_pdf(pdf_content):
+    # Imported here so worker processes load PyMuPDF themselves instead of inheriting it
+    import fitz  # PyMuPDF
+
+    try:
+        with fitz.open(stream=pdf_content, filetype="pdf") as doc:
+            return "\n".join(page.get_text("text") for page in doc)
+    except Exception as e:
+        print(f"Error extracting text from PDF: {e}")
+        return ""
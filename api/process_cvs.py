@@ -4,238 +4,585 @@ import sys
 # Add current directory to sys.path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-import time
-import json
+import re
+import functools
+import asyncio
+import contextlib
+import httpx
+import tiktoken
 import yaml
-from supabase import create_client, Client
-import fitz  # PyMuPDF
+from collections import defaultdict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from aiolimiter import AsyncLimiter
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
-from .llm_factory import LLMFactory
+from .llm_factory import LLMFactory, analysis_events
+from .schemas import ExtractedInfo
+from .pdf_extractor import extract_text_from_pdf
 
 # Load environment variables
 load_dotenv()
 
-# Supabase setup
-url: str = os.environ.get("VITE_SUPABASE_URL") or os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or os.environ.get("VITE_SUPABASE_KEY") or os.environ.get("VITE_SUPABASE_PUBLISHABLE_KEY") or os.environ.get("SUPABASE_KEY")
+def first_env(*keys):
+    # Value of the first of the given env vars that is set
+    return next((os.environ[k] for k in keys if os.environ.get(k)), None)
+
+# Supabase setup (the client is created on first use, not at import time)
+SUPABASE_POOL_SIZE = int(os.environ.get("SUPABASE_POOL_SIZE", "20"))
+# Rows per page; keep at or below the PostgREST max-rows setting (1000 by default)
+SUPABASE_PAGE_SIZE = int(os.environ.get("SUPABASE_PAGE_SIZE", "1000"))
+# Candidate ids per existing-scores query
+SCORE_QUERY_CHUNK = 100
+# Max score rows per upsert
+UPSERT_CHUNK = 500
+
+@functools.lru_cache(maxsize=None)
+def get_supabase() -> Client:
+    url = first_env("VITE_SUPABASE_URL", "SUPABASE_URL")
+    key = first_env("SUPABASE_SERVICE_ROLE_KEY", "VITE_SUPABASE_KEY", "VITE_SUPABASE_PUBLISHABLE_KEY", "SUPABASE_KEY")
+
+    if not url or not key:
+        raise ValueError("Supabase URL or Key is missing in .env")
+
+    # Warn if using publishable key (RLS might block access)
+    if "SERVICE_ROLE" not in (os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or "") and "public" in key:
+        print("\nWARNING: You seem to be using a public/anon key. Row Level Security (RLS) might prevent this script from seeing all jobs or candidates.")
+        print("Please add SUPABASE_SERVICE_ROLE_KEY=... to your backend/.env file for full access.\n")
+
+    # Share one HTTP/2 connection pool across all REST and storage calls, sized for
+    # the concurrent score/candidate queries issued from worker threads. A custom client
+    # replaces supabase-py's own, so restore postgrest's 120s timeout and redirect
+    # following; httpx's 5s default would cut off the bulk upserts and candidate fetch
+    http_client = httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(120),
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=SUPABASE_POOL_SIZE, max_connections=SUPABASE_POOL_SIZE)
+    )
+    return create_client(url, key, options=ClientOptions(httpx_client=http_client))
+
+# Load Configuration (optional config.yaml, overridden by Env)
+file_config = {}
+config_path = os.environ.get("LLM_CONFIG_PATH")
+if config_path:
+    try:
+        with open(config_path, "r") as f:
+            file_config = (yaml.safe_load(f) or {}).get("llm", {})
+    except FileNotFoundError:
+        print("Config file not found, using defaults.")
 
-if not url or not key:
-    print("Error: Supabase URL or Key is missing in .env")
-    exit(1)
+llm_config = {
+    "provider": os.environ.get("LLM_PROVIDER") or file_config.get("provider", "google"),
+    "model": os.environ.get("LLM_MODEL") or file_config.get("model", "gemini-2.0-flash")
+}
 
-# Warn if using publishable key (RLS might block access)
-if "SERVICE_ROLE" not in (os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or "") and "public" in key:
-    print("\nWARNING: You seem to be using a public/anon key. Row Level Security (RLS) might prevent this script from seeing all jobs or candidates.")
-    print("Please add SUPABASE_SERVICE_ROLE_KEY=... to your backend/.env file for full access.\n")
+# Concurrency limits for LLM calls
+ASYNC_CONCURRENCY = int(os.environ.get("ASYNC_CONCURRENCY", "5"))
+LLM_RPM = int(os.environ.get("LLM_RPM", "30"))
+# Submit all prompts through the provider's batch endpoint instead of one request each
+LLM_BATCH_MODE = os.environ.get("LLM_BATCH_MODE", "false").lower() == "true"
+# Seconds between checks on submitted provider batches
+LLM_BATCH_POLL_INTERVAL = int(os.environ.get("LLM_BATCH_POLL_INTERVAL", "60"))
 
-supabase: Client = create_client(url, key)
+# Token budget for the CV text sent to the LLM
+MAX_CV_TOKENS = int(os.environ.get("MAX_CV_TOKENS", "4000"))
 
-# Load Configuration from Env
-llm_config = {
-    "provider": os.environ.get("LLM_PROVIDER", "google"),
-    "model": os.environ.get("LLM_MODEL", "gemini-2.0-flash")
+# Static instructions and output schema, sent as the system prompt so providers
+# can cache it instead of re-processing it for every candidate
+SYSTEM_PROMPT = """
+You are an expert HR recruiter. Evaluate the candidate CV in the user message against the Job Descriptions provided with it.
+
+Analyze the match for EACH job, returning one entry in "evaluations" per JOB ID.
+
+Also, extract the following information from the CV (once):
+- Candidate Name (Full Name)
+- Email
+- Phone Number
+- Years of Experience (as a number)
+- Education Level (e.g., Bachelor, Master, PhD, High School)
+
+Output strictly in JSON format with the following structure:
+{
+    "extracted_info": {
+        "full_name": "<string or null>",
+        "email": "<email or null>",
+        "phone": "<string or null>",
+        "years_of_experience": <number or null>,
+        "education_level": "<string or null>"
+    },
+    "evaluations": [
+        {
+            "job_id": "<JOB ID>",
+            "overall_score": <integer 0-100>,
+            "experience_score": <integer 0-100>,
+            "skills_score": <integer 0-100>,
+            "education_score": <integer 0-100>,
+            "location_score": <integer 0-100>,
+            "analysis": {
+                "summary": "<Concise professional summary>",
+                "green_flags": ["<flag1>", "<flag2>"],
+                "red_flags": ["<flag1>", "<flag2>"],
+                "experience_analysis": "<Concise analysis>",
+                "education_analysis": "<Concise analysis>",
+                "skills_analysis": "<Concise analysis>",
+                "match_reasoning": "<Why good/bad fit>"
+            }
+        }
+    ]
 }
+"""
 
 # Initialize LLM Provider
 try:
-    llm_provider = LLMFactory.create_provider(llm_config)
+    llm_provider = LLMFactory.create_provider(llm_config, system_prompt=SYSTEM_PROMPT)
     print(f"Using LLM Provider: {llm_config.get('provider')} ({llm_config.get('model')})")
 except Exception as e:
     print(f"Error initializing LLM provider: {e}")
     exit(1)
 
-def extract_text_from_pdf(pdf_content):
+if LLM_BATCH_MODE and not llm_provider.supports_batch:
+    print(f"{llm_config.get('provider')} has no batch endpoint, evaluating candidates concurrently instead.")
+    LLM_BATCH_MODE = False
+
+# Names that are really upload filenames, e.g. "CV con foto" or "cv_mario.pdf"
+PLACEHOLDER_NAME = re.compile(r"\Acv |\.pdf\Z", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=None)
+def get_cv_encoding():
+    # Loaded on first use: tiktoken downloads the BPE file on a cold start
     try:
-        doc = fitz.open(stream=pdf_content, filetype="pdf")
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        return text
+        return tiktoken.get_encoding("cl100k_base")
     except Exception as e:
-        print(f"Error extracting text from PDF: {e}")
-        return ""
+        print(f"Error loading tokenizer, truncating CVs by characters instead: {e}")
+        return None
+
+def truncate_cv_text(cv_text):
+    cv_encoding = get_cv_encoding()
+    if cv_encoding is None:
+        # Roughly 4 characters per token
+        return cv_text[:MAX_CV_TOKENS * 4]
+
+    # Cut on token boundaries so the budget holds regardless of the CV's language
+    tokens = cv_encoding.encode(cv_text, disallowed_special=())
+    if len(tokens) <= MAX_CV_TOKENS:
+        return cv_text
+    return cv_encoding.decode(tokens[:MAX_CV_TOKENS])
+
+def build_jobs_section(jobs):
+    return "".join(
+        f"""
+JOB ID: {job['id']}
+Title: {job['title']}
+Description: {job['description']}
+Requirements: {job['requirements']}
+Required Skills: {', '.join(job.get('required_skills') or [])}
+---
+"""
+        for job in jobs
+    )
+
+def make_pdf_executor():
+    # Daemonic processes can't start children of their own, so fall back to threads there.
+    # Celery prefork children are daemonic: the process pool (and its GIL bypass) only
+    # applies to the CLI, the worker extracts text on threads
+    if multiprocessing.current_process().daemon:
+        return ThreadPoolExecutor(max_workers=os.cpu_count())
+    return ProcessPoolExecutor(max_workers=os.cpu_count())
+
+def get_cv_path(candidate):
+    # Extract path from URL (assuming standard Supabase storage URL structure)
+    # URL format: .../storage/v1/object/public/cv-files/user_id/filename.pdf
+    return candidate["cv_file_url"].split("/cv-files/")[-1]
+
+async def create_signed_urls(paths):
+    # One storage call for every CV instead of a download round-trip per candidate
+    try:
+        response = await asyncio.to_thread(get_supabase().storage.from_("cv-files").create_signed_urls, paths, 3600)
+    except Exception as e:
+        # Candidates without a signed URL are skipped, as with a failed download
+        print(f"Error signing CV URLs: {e}")
+        return {}
+    return {
+        item["path"]: item.get("signedURL") or item.get("signedUrl")
+        for item in response
+        if not item.get("error")
+    }
+
+async def fetch_existing_score_chunk(candidate_ids):
+    # Page through the rows: PostgREST silently truncates responses at its max-rows limit
+    rows = []
+    offset = 0
+    while True:
+        response = await asyncio.to_thread(
+            get_supabase().from_("candidate_scores").select("candidate_id, job_posting_id")
+            .in_("candidate_id", candidate_ids).order("id")
+            .range(offset, offset + SUPABASE_PAGE_SIZE - 1).execute
+        )
+        rows.extend(response.data)
+        if len(response.data) < SUPABASE_PAGE_SIZE:
+            return rows
+        offset += SUPABASE_PAGE_SIZE
+
+async def fetch_existing_scores(candidates):
+    # A few chunked queries instead of one per candidate; chunking keeps the in_() URL short
+    candidate_ids = [c['id'] for c in candidates]
+    chunks = await asyncio.gather(*[
+        fetch_existing_score_chunk(candidate_ids[i:i + SCORE_QUERY_CHUNK])
+        for i in range(0, len(candidate_ids), SCORE_QUERY_CHUNK)
+    ])
+    existing_scores = defaultdict(set)
+    for rows in chunks:
+        for item in rows:
+            existing_scores[item['candidate_id']].add(item['job_posting_id'])
+    return existing_scores
+
+def get_jobs_to_evaluate(candidate, jobs, existing_job_ids):
+    # Check if we need to re-run to extract info (name, phone, etc.)
+    name_needs_update = bool(PLACEHOLDER_NAME.search(candidate['full_name']))
+    phone_needs_update = not candidate.get('phone')
+
+    if name_needs_update or phone_needs_update:
+        # If info is missing, evaluate against ALL open jobs to ensure we get the info and fresh scores
+        return jobs
+    # Otherwise, only evaluate against new jobs
+    return [j for j in jobs if j['id'] not in existing_job_ids]
+
+async def prepare_candidate(candidate, jobs, all_jobs_section, existing_job_ids, http_client, signed_urls, pdf_executor):
+    # Returns the evaluation task for this candidate, or None if there is nothing to do
+    print(f"\nProcessing candidate: {candidate['full_name']} (ID: {candidate['id']})")
+
+    # 3. Determine jobs to evaluate (existing_job_ids lets us avoid re-work)
+    jobs_to_evaluate = get_jobs_to_evaluate(candidate, jobs, existing_job_ids)
+    if not jobs_to_evaluate:
+        print(f"  - {candidate['full_name']}: All jobs scored and info complete, skipping.")
+        return None
+
+    # 4. Download CV (only if needed)
+    if not candidate.get("cv_file_url"):
+        print(f"  - {candidate['full_name']}: No CV URL found, skipping.")
+        return None
 
-def process_cvs():
-    # 1. Fetch all open job postings
-    print("Fetching open job postings...")
-    jobs_response = supabase.from_("job_postings").select("*").eq("status", "open").execute()
-    jobs = jobs_response.data
-    
-    if not jobs:
-        print("No open job postings found.")
-        return
+    try:
+        cv_path = get_cv_path(candidate)
+        signed_url = signed_urls.get(cv_path)
+        if not signed_url:
+            print(f"  - {candidate['full_name']}: Could not sign CV URL, skipping.")
+            return None
+
+        print(f"  - Downloading CV: {cv_path}")
+        response = await http_client.get(signed_url)
+        response.raise_for_status()
+        cv_data = response.content
+
+        # Text extraction is CPU-bound, so run it in a worker process off the event loop
+        loop = asyncio.get_running_loop()
+        cv_text = await loop.run_in_executor(pdf_executor, extract_text_from_pdf, cv_data)
+        if not cv_text:
+            print(f"  - {candidate['full_name']}: Could not extract text from CV, skipping.")
+            return None
 
-    print(f"Found {len(jobs)} open jobs.")
+    except Exception as e:
+        print(f"  - {candidate['full_name']}: Error downloading/reading CV: {e}")
+        return None
 
-    # 2. Fetch all candidates
-    print("Fetching candidates...")
-    candidates_response = supabase.from_("candidates").select("*").execute()
-    candidates = candidates_response.data
+    print(f"  - {candidate['full_name']}: Evaluating against {len(jobs_to_evaluate)} jobs...")
 
-    if not candidates:
-        print("No candidates found.")
-        return
+    # 4. Construct Batch Prompt (reuse the shared section when evaluating all jobs)
+    if jobs_to_evaluate is jobs:
+        jobs_section = all_jobs_section
+    else:
+        jobs_section = build_jobs_section(jobs_to_evaluate)
 
-    print(f"Found {len(candidates)} candidates.")
+    prompt = f"""
+JOBS TO EVALUATE:
+{jobs_section}
 
-    for candidate in candidates:
-        print(f"\nProcessing candidate: {candidate['full_name']} (ID: {candidate['id']})")
-        
-        # 3. Determine jobs to evaluate
-        # Fetch existing scores for this candidate to avoid re-work
-        existing_scores_response = supabase.from_("candidate_scores").select("job_posting_id").eq("candidate_id", candidate['id']).execute()
-        existing_job_ids = {item['job_posting_id'] for item in existing_scores_response.data}
-
-        # Check if we need to re-run to extract info (name, phone, etc.)
-        name_needs_update = candidate['full_name'].lower().startswith('cv ') or candidate['full_name'].lower().endswith('.pdf') or candidate['full_name'] == "CV con foto"
-        phone_needs_update = not candidate.get('phone')
-        
-        jobs_to_evaluate = []
-        if name_needs_update or phone_needs_update:
-            # If info is missing, evaluate against ALL open jobs to ensure we get the info and fresh scores
-            jobs_to_evaluate = jobs
-        else:
-            # Otherwise, only evaluate against new jobs
-            jobs_to_evaluate = [j for j in jobs if j['id'] not in existing_job_ids]
-
-        if not jobs_to_evaluate:
-            print("  - All jobs scored and info complete, skipping.")
-            continue
+CANDIDATE CV:
+{truncate_cv_text(cv_text)}
+"""
+
+    return {"candidate": candidate, "jobs": jobs_to_evaluate, "prompt": prompt}
+
+async def update_candidate_info(candidate, extracted: ExtractedInfo):
+    update_data = {}
+    if extracted.full_name: update_data["full_name"] = extracted.full_name
+    if extracted.email: update_data["email"] = extracted.email
+    if extracted.phone: update_data["phone"] = extracted.phone
+    if extracted.years_of_experience is not None:
+        update_data["years_of_experience"] = int(extracted.years_of_experience)
+    if extracted.education_level: update_data["education_level"] = extracted.education_level
+
+    if update_data:
+        await asyncio.to_thread(
+            get_supabase().from_("candidates").update(update_data).eq("id", candidate['id']).execute
+        )
+        print(f"    - {candidate['full_name']}: Candidate info updated: {update_data.keys()}")
+
+async def save_results(task, events, score_queue):
+    # Consumes the LLM's analysis events, updates the candidate's info and
+    # queues each score row for the writer as soon as its evaluation arrives
+    candidate = task["candidate"]
+    valid_job_ids = {j['id'] for j in task["jobs"]}
+    info_update = None
+    received = False
+
+    try:
+        # 5. Process Results
+        async for kind, value in events:
+            received = True
+
+            if kind == "extracted_info":
+                # Don't hold up the stream on the update. Gemini emits this section last
+                # (properties come out in alphabetical order), other providers first
+                info_update = asyncio.create_task(update_candidate_info(candidate, value))
+                continue
 
-        # 4. Download CV (only if needed)
-        if not candidate.get("cv_file_url"):
-            print("  - No CV URL found, skipping.")
+            evaluation = value
+            # Verify job_id exists in our list (sanity check)
+            if evaluation.job_id not in valid_job_ids:
+                print(f"    - Warning: LLM returned evaluation for unknown/unrequested job {evaluation.job_id}, skipping.")
+                continue
+
+            score_data = {
+                "candidate_id": candidate['id'],
+                "job_posting_id": evaluation.job_id,
+                "overall_score": evaluation.overall_score,
+                "experience_score": evaluation.experience_score,
+                "skills_score": evaluation.skills_score,
+                "education_score": evaluation.education_score,
+                "location_score": evaluation.location_score,
+                "score_details": evaluation.analysis.model_dump()
+            }
+
+            score_queue.put_nowait(score_data)
+            print(f"    - {candidate['full_name']}: Score for job {evaluation.job_id}: {score_data['overall_score']}")
+
+        if not received:
+            print(f"    - {candidate['full_name']}: Error: Empty response from LLM")
+
+    except Exception as e:
+        print(f"    - {candidate['full_name']}: Error evaluating: {e}")
+
+    if info_update:
+        try:
+            await info_update
+        except Exception as e:
+            print(f"    - {candidate['full_name']}: Error updating candidate info: {e}")
+
+async def save_scores(score_queue):
+    # Upserts score rows while generation is still running: each write takes whatever
+    # has been queued since the previous one, so the writes batch up under load.
+    # A None on the queue marks the end of the run
+    saved = total = 0
+    finished = False
+    while not finished:
+        rows = [await score_queue.get()]
+        while len(rows) < UPSERT_CHUNK and not score_queue.empty():
+            rows.append(score_queue.get_nowait())
+        if rows[-1] is None:
+            finished = True
+            rows.pop()
+        if not rows:
             continue
 
+        # Keep one row per (candidate, job): Postgres rejects an upsert that touches the same row twice
+        rows = list({(row["candidate_id"], row["job_posting_id"]): row for row in rows}.values())
+        total += len(rows)
+        # One failed write only loses its own rows instead of the whole run
         try:
-            # Extract path from URL (assuming standard Supabase storage URL structure)
-            # URL format: .../storage/v1/object/public/cv-files/user_id/filename.pdf
-            cv_path = candidate["cv_file_url"].split("/cv-files/")[-1]
-            
-            print(f"  - Downloading CV: {cv_path}")
-            cv_data = supabase.storage.from_("cv-files").download(cv_path)
-            
-            cv_text = extract_text_from_pdf(cv_data)
-            if not cv_text:
-                print("  - Could not extract text from CV, skipping.")
-                continue
-                
+            await asyncio.to_thread(
+                get_supabase().from_("candidate_scores").upsert(rows, on_conflict="candidate_id, job_posting_id").execute
+            )
+            saved += len(rows)
+        except Exception as e:
+            print(f"Error saving {len(rows)} scores: {e}")
+
+    if total:
+        print(f"\nSaved {saved} of {total} scores.")
+
+@contextlib.asynccontextmanager
+async def score_writer():
+    # Scores are saved by a single writer as the evaluations come in
+    score_queue = asyncio.Queue()
+    writer = asyncio.create_task(save_scores(score_queue))
+    try:
+        yield score_queue
+    finally:
+        # Let the writer flush what is still queued
+        score_queue.put_nowait(None)
+        await writer
+
+async def submit_batch(tasks, score_queue):
+    # Saves cached results right away and submits the rest as one provider batch. The batch
+    # is recorded in llm_batches so that a later run or the collect_batches task saves it
+    cached = await asyncio.gather(*[asyncio.to_thread(llm_provider.get_cached, t["prompt"]) for t in tasks])
+    await asyncio.gather(*[save_results(t, analysis_events(r), score_queue) for t, r in zip(tasks, cached) if r])
+    tasks = [t for t, r in zip(tasks, cached) if not r]
+    if not tasks:
+        return
+
+    print(f"\nSubmitting {len(tasks)} prompts as a batch...")
+    try:
+        batch_id = await asyncio.to_thread(llm_provider.submit_batch, [t["prompt"] for t in tasks])
+    except Exception as e:
+        print(f"Error submitting batch: {e}")
+        return
+
+    requests = [
+        {"candidate_id": t["candidate"]["id"], "full_name": t["candidate"]["full_name"], "job_ids": [j["id"] for j in t["jobs"]]}
+        for t in tasks
+    ]
+    try:
+        await asyncio.to_thread(
+            get_supabase().from_("llm_batches").insert({
+                "batch_id": batch_id,
+                "provider": llm_config["provider"],
+                "requests": requests
+            }).execute
+        )
+    except Exception as e:
+        print(f"Error recording batch {batch_id}, its results won't be collected: {e}")
+
+async def collect_finished_batches(score_queue):
+    # Saves the results of batches that have finished; returns the ones still running
+    try:
+        response = await asyncio.to_thread(
+            get_supabase().from_("llm_batches").select("*")
+            .eq("provider", llm_config["provider"]).eq("status", "submitted").execute
+        )
+    except Exception as e:
+        print(f"Error fetching submitted batches: {e}")
+        return []
+
+    running = []
+    for batch in response.data:
+        requests = batch["requests"]
+        try:
+            results = await asyncio.to_thread(llm_provider.collect_batch, batch["batch_id"], len(requests))
         except Exception as e:
-            print(f"  - Error downloading/reading CV: {e}")
+            print(f"Error checking batch {batch['batch_id']}: {e}")
+            results = None
+        if results is None:
+            running.append(batch)
             continue
 
-        print(f"  - Evaluating against {len(jobs_to_evaluate)} jobs...")
+        # Claim the batch so an overlapping collector doesn't save it twice
+        claimed = await asyncio.to_thread(
+            get_supabase().from_("llm_batches").update({"status": "collected"})
+            .eq("id", batch["id"]).eq("status", "submitted").execute
+        )
+        if not claimed.data:
+            continue
 
-        # 4. Construct Batch Prompt
-        jobs_section = ""
-        for job in jobs_to_evaluate:
-            jobs_section += f"""
-JOB ID: {job['id']}
-Title: {job['title']}
-Description: {job['description']}
-Requirements: {job['requirements']}
-Required Skills: {', '.join(job.get('required_skills') or [])}
----
-"""
+        print(f"\nCollecting batch {batch['batch_id']} ({len(requests)} candidates)...")
+        tasks = [
+            {"candidate": {"id": r["candidate_id"], "full_name": r["full_name"]}, "jobs": [{"id": job_id} for job_id in r["job_ids"]]}
+            for r in requests
+        ]
+        await asyncio.gather(*[save_results(t, analysis_events(r), score_queue) for t, r in zip(tasks, results)])
 
-        prompt = f"""
-You are an expert HR recruiter. Evaluate the following candidate CV against the provided Job Descriptions.
+    return running
 
-JOBS TO EVALUATE:
-{jobs_section}
+async def process_candidate(candidate, jobs, all_jobs_section, existing_job_ids, http_client, signed_urls, pdf_executor, score_queue, semaphore, limiter):
+    task = await prepare_candidate(candidate, jobs, all_jobs_section, existing_job_ids, http_client, signed_urls, pdf_executor)
+    if not task:
+        return
 
-CANDIDATE CV:
-{cv_text[:15000]} 
+    # Cap in-flight requests and pace them to stay within the provider's RPM quota
+    async with semaphore, limiter:
+        await save_results(task, llm_provider.stream_analysis(task["prompt"]), score_queue)
 
-Analyze the match for EACH job.
+async def evaluate_candidates(job_id=None):
+    running_batches = []
+    if llm_provider.supports_batch:
+        # Save batches that finished since the last run before deciding what is left to score
+        async with score_writer() as score_queue:
+            running_batches = await collect_finished_batches(score_queue)
 
-Also, extract the following information from the CV (once):
-- Candidate Name (Full Name)
-- Email
-- Phone Number
-- Years of Experience (as a number)
-- Education Level (e.g., Bachelor, Master, PhD, High School)
+    # 1. Fetch all open job postings (or only the requested one)
+    print("Fetching open job postings...")
+    jobs_query = get_supabase().from_("job_postings").select("*").eq("status", "open")
+    if job_id:
+        jobs_query = jobs_query.eq("id", job_id)
+    jobs_response = await asyncio.to_thread(jobs_query.execute)
+    jobs = jobs_response.data
+    
+    if not jobs:
+        print("No open job postings found.")
+        return
 
-Output strictly in JSON format with the following structure:
-{{
-    "extracted_info": {{
-        "full_name": "<string or null>",
-        "email": "<email or null>",
-        "phone": "<string or null>",
-        "years_of_experience": <number or null>,
-        "education_level": "<string or null>"
-    }},
-    "evaluations": {{
-        "<job_id>": {{
-            "overall_score": <number 0-100>,
-            "experience_score": <number 0-100>,
-            "skills_score": <number 0-100>,
-            "education_score": <number 0-100>,
-            "location_score": <number 0-100>,
-            "analysis": {{
-                "summary": "<Concise professional summary>",
-                "green_flags": ["<flag1>", "<flag2>"],
-                "red_flags": ["<flag1>", "<flag2>"],
-                "experience_analysis": "<Concise analysis>",
-                "education_analysis": "<Concise analysis>",
-                "skills_analysis": "<Concise analysis>",
-                "match_reasoning": "<Why good/bad fit>"
-            }}
-        }}
-    }}
-}}
-"""
+    print(f"Found {len(jobs)} open jobs.")
 
-        try:
-            result = llm_provider.generate_analysis(prompt)
-            
-            if not result:
-                print("    - Error: Empty response from LLM")
-                continue
+    # 2. Fetch all candidates
+    print("Fetching candidates...")
+    candidates_response = await asyncio.to_thread(get_supabase().from_("candidates").select("*").execute)
+    candidates = candidates_response.data
+
+    if not candidates:
+        print("No candidates found.")
+        return
 
-            # 5. Process Results
-            
-            # Update candidate info
-            extracted = result.get("extracted_info", {})
-            update_data = {}
-            if extracted.get("full_name"): update_data["full_name"] = extracted["full_name"]
-            if extracted.get("email"): update_data["email"] = extracted["email"]
-            if extracted.get("phone"): update_data["phone"] = extracted["phone"]
-            if extracted.get("years_of_experience") is not None:
-                try:
-                    update_data["years_of_experience"] = int(float(extracted["years_of_experience"]))
-                except (ValueError, TypeError):
-                    pass 
-            if extracted.get("education_level"): update_data["education_level"] = extracted["education_level"]
-            
-            if update_data:
-                supabase.from_("candidates").update(update_data).eq("id", candidate['id']).execute()
-                print(f"    - Candidate info updated: {update_data.keys()}")
-
-            # Insert Scores
-            evaluations = result.get("evaluations", {})
-            for job_id, eval_data in evaluations.items():
-                # Verify job_id exists in our list (sanity check)
-                if not any(j['id'] == job_id for j in jobs_to_evaluate):
-                    print(f"    - Warning: LLM returned evaluation for unknown/unrequested job {job_id}, skipping.")
-                    continue
-
-                score_data = {
-                    "candidate_id": candidate['id'],
-                    "job_posting_id": job_id,
-                    "overall_score": eval_data.get("overall_score", 0),
-                    "experience_score": eval_data.get("experience_score", 0),
-                    "skills_score": eval_data.get("skills_score", 0),
-                    "education_score": eval_data.get("education_score", 0),
-                    "location_score": eval_data.get("location_score", 0),
-                    "score_details": eval_data.get("analysis", {})
-                }
-                
-                supabase.from_("candidate_scores").upsert(score_data, on_conflict="candidate_id, job_posting_id").execute()
-                print(f"    - Score saved for job {job_id}: {score_data['overall_score']}")
+    print(f"Found {len(candidates)} candidates.")
 
-        except Exception as e:
-            print(f"    - Error evaluating: {e}")
+    # Candidates in a batch that is still running get their scores when it is collected
+    batched_ids = {r["candidate_id"] for batch in running_batches for r in batch["requests"]}
+    if batched_ids:
+        candidates = [c for c in candidates if c['id'] not in batched_ids]
+        print(f"Skipping {len(batched_ids)} candidates waiting on a running batch.")
+
+    existing_scores = await fetch_existing_scores(candidates)
+    all_jobs_section = build_jobs_section(jobs)
+
+    # Sign the CV paths up front so the downloads can run in parallel, but only for
+    # candidates that still have work, so the request doesn't grow with the whole table
+    cv_paths = [
+        get_cv_path(c) for c in candidates
+        if c.get("cv_file_url") and get_jobs_to_evaluate(c, jobs, existing_scores[c['id']])
+    ]
+    signed_urls = await create_signed_urls(cv_paths) if cv_paths else {}
+
+    async with score_writer() as score_queue:
+        with make_pdf_executor() as pdf_executor:
+            async with httpx.AsyncClient(http2=True) as http_client:
+                if LLM_BATCH_MODE:
+                    # Collect every prompt first, then submit them to the provider as a single batch
+                    tasks = await asyncio.gather(*[
+                        prepare_candidate(c, jobs, all_jobs_section, existing_scores[c['id']], http_client, signed_urls, pdf_executor)
+                        for c in candidates
+                    ])
+                    await submit_batch([t for t in tasks if t], score_queue)
+                else:
+                    # Candidates are independent, so evaluate them concurrently
+                    semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+                    limiter = AsyncLimiter(LLM_RPM, 60)
+                    await asyncio.gather(*[
+                        process_candidate(c, jobs, all_jobs_section, existing_scores[c['id']], http_client, signed_urls, pdf_executor, score_queue, semaphore, limiter)
+                        for c in candidates
+                    ])
+
+async def process_cvs_async(job_id=None):
+    try:
+        await evaluate_candidates(job_id)
+    finally:
+        # Async LLM clients belong to this run's event loop, so release them before it closes
+        await llm_provider.aclose()
+
+def process_cvs(job_id=None):
+    asyncio.run(process_cvs_async(job_id))
+
+async def collect_batches_async():
+    try:
+        async with score_writer() as score_queue:
+            return len(await collect_finished_batches(score_queue))
+    finally:
+        await llm_provider.aclose()
+
+def collect_batches():
+    # Saves finished provider batches; returns how many are still running
+    if not llm_provider.supports_batch:
+        return 0
+    return asyncio.run(collect_batches_async())
 
 if __name__ == "__main__":
     process_cvs()
@@ -0,0 +1,43 @@
+from typing import Annotated
+from pydantic import AfterValidator, BaseModel
+
+def check_score(value: int) -> int:
+    # Range is checked here rather than with Field(ge=, le=) so it stays out of the
+    # JSON schema sent to the providers, which don't all accept minimum/maximum
+    if not 0 <= value <= 100:
+        raise ValueError(f"score must be between 0 and 100, got {value}")
+    return value
+
+Score = Annotated[int, AfterValidator(check_score)]
+
+class ExtractedInfo(BaseModel):
+    # Required-but-nullable: a default would put "default" into the schema, which Gemini rejects
+    full_name: str | None
+    email: str | None
+    phone: str | None
+    years_of_experience: float | None
+    education_level: str | None
+
+class Analysis(BaseModel):
+    summary: str
+    green_flags: list[str]
+    red_flags: list[str]
+    experience_analysis: str
+    education_analysis: str
+    skills_analysis: str
+    match_reasoning: str
+
+class Evaluation(BaseModel):
+    job_id: str
+    overall_score: Score
+    experience_score: Score
+    skills_score: Score
+    education_score: Score
+    location_score: Score
+    analysis: Analysis
+
+class AnalysisResult(BaseModel):
+    # Evaluations are a list carrying their job_id because structured output
+    # schemas can't describe an object keyed by arbitrary job ids
+    extracted_info: ExtractedInfo
+    evaluations: list[Evaluation]
@@ -0,0 +1,22 @@
+import os
+import sys
+
+# Add current directory to sys.path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from .celery_app import celery_app, RUN_ANALYSIS_TASK
+from . import process_cvs
+
+@celery_app.task(name=RUN_ANALYSIS_TASK)
+def run_analysis(job_id: str | None = None):
+    process_cvs.process_cvs(job_id)
+    if process_cvs.LLM_BATCH_MODE:
+        # The provider returns batch results hours later, so poll for them from a separate task
+        collect_batches.apply_async(countdown=process_cvs.LLM_BATCH_POLL_INTERVAL)
+
+@celery_app.task(name="collect_batches")
+def collect_batches():
+    # Re-queues itself until every submitted batch has been saved. The batch ids are
+    # kept in llm_batches, so a restarted worker or the next run picks them up too
+    if process_cvs.collect_batches():
+        collect_batches.apply_async(countdown=process_cvs.LLM_BATCH_POLL_INTERVAL)
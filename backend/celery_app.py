@@ -0,0 +1,14 @@
+import os
+import sys
+from dotenv import load_dotenv
+
+# The Celery app lives in api/celery_app.py; this module loads it with the
+# local backend's .env.
+backend_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(backend_dir))
+
+load_dotenv(os.path.join(backend_dir, ".env"))
+
+from api.celery_app import celery_app, RUN_ANALYSIS_TASK
+
+__all__ = ["celery_app", "RUN_ANALYSIS_TASK"]
@@ -0,0 +1,6 @@
+# The Celery tasks live in api/tasks.py; going through the process_cvs shim first
+# applies the local backend's .env and config.yaml
+from process_cvs import process_cvs
+from api.tasks import celery_app, run_analysis, collect_batches
+
+__all__ = ["celery_app", "process_cvs", "run_analysis", "collect_batches"]
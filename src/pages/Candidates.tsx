@@ -54,6 +54,9 @@ interface JobPosting {
   created_at: string;
 }
 
+const ANALYSIS_POLL_INTERVAL_MS = 3000;
+const ANALYSIS_TIMEOUT_MS = 30 * 60 * 1000;
+
 const Candidates = () => {
   const navigate = useNavigate();
   const { toast } = useToast();
@@ -191,7 +194,26 @@ const Candidates = () => {
         throw new Error("Errore nella comunicazione con il server");
       }
 
-      const result = await response.json();
+      const { task_id } = await response.json();
+
+      // The analysis runs in a background worker: poll until it finishes or we give up
+      const deadline = Date.now() + ANALYSIS_TIMEOUT_MS;
+      let state = "PENDING";
+      while (state !== "SUCCESS" && state !== "FAILURE" && state !== "REVOKED") {
+        if (Date.now() > deadline) {
+          throw new Error("Tempo massimo di attesa superato per l'analisi");
+        }
+        await new Promise((resolve) => setTimeout(resolve, ANALYSIS_POLL_INTERVAL_MS));
+        const statusResponse = await fetch(`${apiUrl}/api/analyze/status/${task_id}`);
+        if (!statusResponse.ok) {
+          throw new Error("Errore nella comunicazione con il server");
+        }
+        ({ status: state } = await statusResponse.json());
+      }
+
+      if (state !== "SUCCESS") {
+        throw new Error("Analisi fallita");
+      }
       
       if (!silent) {
         toast({
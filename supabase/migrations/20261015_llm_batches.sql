@@ -0,0 +1,17 @@
+-- Migration: Track provider batch jobs submitted by the CV analysis
+
+-- 1. One row per submitted batch; requests lists the candidate and job ids of
+--    each prompt in submission order, so results can be matched back to them
+CREATE TABLE public.llm_batches (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  batch_id TEXT NOT NULL UNIQUE,
+  provider TEXT NOT NULL,
+  requests JSONB NOT NULL,
+  status TEXT NOT NULL DEFAULT 'submitted' CHECK (status IN ('submitted', 'collected')),
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX llm_batches_status_idx ON public.llm_batches (status);
+
+-- 2. Only the service role (the analysis worker) reads or writes batches
+ALTER TABLE public.llm_batches ENABLE ROW LEVEL SECURITY;